@@ -1,4 +1,6 @@
 #!/usr/bin/env python
+import time
+_startup_t0 = time.perf_counter()
 from tkinter import *
 from tkinter import messagebox
 import os
@@ -7,17 +9,18 @@ import sys
 import socket
 from time import sleep
 import zmq
-import time
 import logging
 import glob
 import wave
 import datetime
+import importlib
+import contextlib
+import json
+import re
+import shutil
 import numpy as np
-import scipy.io.wavfile as wavfile
-from PIL import Image, ImageTk
-from paramiko import SSHClient
-from scp import SCPClient
-from serial_commander import conex_interface as sc
+import rig_protocol
+_startup_import_s = time.perf_counter() - _startup_t0
 
 #################################
 ## ACUTE RIG CONTROL GUI!      ##
@@ -25,19 +28,106 @@ from serial_commander import conex_interface as sc
 ## With code from Zeke Arneodo ##
 #################################
 
+LOGO_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'glab.png')
+LOGO_CACHE_DIR = os.path.expanduser('~/.cache/glab_oe_rig_tools')
+
+# Heavy subsystems (scipy, PIL, paramiko/scp, serial_commander) are only imported
+# the first time their feature is used, so a missing package only breaks that feature.
+# Import and initialisation costs are collected here as {subsystem: {phase: seconds}}.
+startup_times = {'core': {'import': _startup_import_s}}
+
+
+def record_time(subsystem, phase, seconds):
+    phases = startup_times.setdefault(subsystem, {})
+    phases[phase] = phases.get(phase, 0.) + seconds
+
 
-def parse_command(cmd_str):
+@contextlib.contextmanager
+def timed(subsystem, phase='init'):
+    t0 = time.perf_counter()
+    try:
+        yield
+    finally:
+        record_time(subsystem, phase, time.perf_counter() - t0)
+
+
+def lazy_import(subsystem, module_name):
+    """
+    Import a module on first use and record the import cost for its subsystem
+    :param subsystem: name the cost is reported under
+    :param module_name: dotted module name
+    :return: the module (raises ImportError if it is not installed)
+    """
+    module = sys.modules.get(module_name)
+    if module is None:
+        t0 = time.perf_counter()
+        module = importlib.import_module(module_name)
+        elapsed = time.perf_counter() - t0
+        record_time(subsystem, 'import', elapsed)
+        print('Loaded {} for {} in {:.3f} s'.format(module_name, subsystem, elapsed))
+    return module
+
+
+def print_startup_report():
+    print('Startup time by subsystem:')
+    print('  {:<16s} {:>9s} {:>9s}'.format('subsystem', 'import', 'init'))
+    total = 0.
+    for subsystem, phases in sorted(startup_times.items(), key=lambda kv: -sum(kv[1].values())):
+        imp = phases.get('import', 0.)
+        init = phases.get('init', 0.)
+        total += imp + init
+        print('  {:<16s} {:8.3f}s {:8.3f}s'.format(subsystem, imp, init))
+    print('  {:<16s} {:8.3f}s'.format('total', total))
+
+
+def load_logo(size=(256, 64)):
+    """
+    Lab logo scaled to size. The scaled copy is cached so later startups
+    neither import PIL nor decode the full resolution png.
+    :return: PhotoImage or None if no logo can be made
+    """
+    cache_path = os.path.join(LOGO_CACHE_DIR, 'glab_{}x{}.png'.format(*size))
+    if os.path.exists(cache_path) and (not os.path.exists(LOGO_PATH)
+                                       or os.path.getmtime(cache_path) >= os.path.getmtime(LOGO_PATH)):
+        return PhotoImage(file=cache_path)
+    try:
+        pil_image = lazy_import('logo', 'PIL.Image')
+        image = pil_image.open(LOGO_PATH).resize(size=size, resample=pil_image.BICUBIC)
+        os.makedirs(LOGO_CACHE_DIR, exist_ok=True)
+        image.save(cache_path)
+    except (ImportError, OSError) as e:
+        print('Could not make logo: {}'.format(e))
+        return None
+    return PhotoImage(file=cache_path)
+
+
+def probe_write_throughput(path, n_bytes=64 * 1024**2, chunk_bytes=4 * 1024**2):
     """
-    # the line has one word for the command and n pairs that go to key, value (separator is space)
-    :param cmd_str: string with name of command and pairs of params and values
-    :return: cmd : str (name of the command)
-            cmd_par: dictionary {par_name: str(par_value)} with the parameters for the command
+    Sequential write rate of the volume holding path, from writing and fsyncing a scratch file
+    :return: bytes/s
     """
-    split_cmd = cmd_str.split(' ')
-    assert (len(split_cmd) % 2)
-    cmd_par = {split_cmd[i]: split_cmd[i + 1] for i in range(1, len(split_cmd), 2)}
-    cmd = split_cmd[0]
-    return cmd, cmd_par
+    chunk = os.urandom(chunk_bytes)
+    probe_file = os.path.join(path, '.write_probe')
+    t0 = time.perf_counter()
+    try:
+        with open(probe_file, 'wb') as f:
+            for _ in range(n_bytes // chunk_bytes):
+                f.write(chunk)
+            f.flush()
+            os.fsync(f.fileno())
+        elapsed = time.perf_counter() - t0
+    finally:
+        if os.path.exists(probe_file):
+            os.remove(probe_file)
+    return n_bytes / elapsed
+
+
+def directory_bytes(path):
+    total = 0
+    for dirpath, _, filenames in os.walk(path):
+        for f in filenames:
+            total += os.path.getsize(os.path.join(dirpath, f))
+    return total
 
 
 class OpenEphysEvents:
@@ -50,6 +140,7 @@ class OpenEphysEvents:
         self.timeout = 5.
         self.last_cmd = None
         self.last_rcv = None
+        self.last_break_s = None
 
     def connect(self):
         url = "tcp://%s:%d" % (self.ip, int(self.port))
@@ -126,10 +217,17 @@ class OpenEphysEvents:
         else:
             print('Was not recording')
 
-    def break_rec(self):
+    def break_rec(self, rec_par=None):
+        """
+        Stop and restart the recording. self.last_break_s is the time from sending
+        StopRecord to Recording being confirmed again on the host, an upper bound on the dead time.
+        :param rec_par: StartRecord options as in start_rec, None restarts with Open Ephys' current settings
+        :return: True if recording restarted
+        """
         ok_to_start = False
         ok_started = False
         print('Breaking recording in progress')
+        t0 = time.perf_counter()
         if self.query_status('Recording'):
             self.send_command('StopRecord')
             if not self.query_status('Recording'):
@@ -144,12 +242,17 @@ class OpenEphysEvents:
 
         if ok_to_start:
             #print('trying to record')
-            self.send_command('StartRecord')
+            rec_opt = ['{0}={1}'.format(key, value)
+                       for key, value in (rec_par or {}).items()
+                       if value is not None]
+            self.send_command(' '.join(['StartRecord'] + rec_opt))
             if self.query_status('Recording'):
                 #print('Recording path: {}'.format(self.get_rec_path()))
                 ok_started = True
             else:
                 print('Something went wrong starting recording')
+        self.last_break_s = time.perf_counter() - t0
+        return ok_started
 
     def get_rec_path(self):
         return self.send_command('GetRecordingPath')
@@ -191,42 +294,77 @@ class RigStateMachineConnection:
         self.socket.SNDTIMEO = self.timeout
         self.socket.connect(url)
 
-    def send_command(self, cmd):
-        self.socket.send_string(cmd)
-        self.last_cmd = cmd
+    def send_commands(self, commands):
+        """
+        Send a batch of commands in one message
+        :param commands: list of (name, params) as in rig_protocol.encode
+        :return: list of (name, params) replies, one per command
+        """
+        self.socket.send(rig_protocol.encode(commands))
+        self.last_cmd = commands
         # stays locked until commands executes and response comes back
         # this should go on a thread of the program that uses it
-        self.last_rcv = self.socket.recv()
+        self.last_rcv = rig_protocol.decode(self.socket.recv())
+        for name, params in self.last_rcv:
+            if name == 'error':
+                print('Pi error: {}'.format(params['message']))
         return self.last_rcv
 
+    def send_command(self, cmd, params=None):
+        return self.send_commands([(cmd, params)])[0]
+
     def close(self):
         self.context.destroy()
 
     def start_trial(self, stimulus_path, number):
-        cmd = 'trial ' + 'stim_file {} '.format(stimulus_path) + 'number {}'.format(number)
-        print('Sending: {}'.format(cmd))
-        self.send_command(cmd)
+        params = {'stim_file': stimulus_path, 'number': int(number)}
+        print('Sending: trial {}'.format(params))
+        return self.send_command('trial', params)
+
+    # The pi answers these while a trial is playing, but this connection is
+    # blocked in start_trial until then, so use them from a second connection.
+    def ping(self):
+        return self.send_command('ping')
+
+    def status(self):
+        """
+        :return: dictionary with state (idle/playing), trial, queue, played, stim_file
+        """
+        _, status = self.send_command('status')
+        return status
+
+    def abort(self):
+        # stops the playing stimulus and drops queued trials
+        return self.send_command('abort')
 
 class CONEXControl:
     def __init__(self, acuterig):
         os.system("xset r off") # Turn off keyboard repeat
+        self.acuterig = acuterig
         self.master = acuterig.conex_window
         self.master.protocol("WM_DELETE_WINDOW", self.on_closing)
         self.zcoord = 0
         self.homepos = 0
         self.disabled = False
+        self.auto_stepping = False # a depth search is driving the stage
         self.posString = StringVar()
         self.posString.set(str(self.zcoord))
         self.initialize_window()
-        self.con = sc.SerialCommander() # Our connection to the drive
-        self.con.reference()
+        sc = lazy_import('conex', 'serial_commander.conex_interface')
+        with timed('conex'):
+            self.con = sc.SerialCommander() # Our connection to the drive
+            self.con.reference()
         self.initial_drive_position = self.con.getCurrPosition()
 
     def setZero(self):
         self.initial_drive_position = self.con.getCurrPosition()
     
     def on_closing(self):
+        if self.auto_stepping:
+            messagebox.showwarning("CONEX Control", "A depth search is driving the stage, stop it first.")
+            return
         os.system("xset r on")
+        self.acuterig.conex_app = None
         self.con.close()
         self.master.destroy()
 
@@ -274,8 +412,41 @@ class CONEXControl:
         self.send_motion_event(dist)
         self.update_position_display()
 
+    def step_and_settle(self, dist, tol=0.5, timeout_s=None):
+        """
+        Relative move that waits for the drive to reach its target instead of a fixed sleep
+        :param dist: um, positive is down
+        :param tol: um from the target that counts as settled
+        :return: True if settled before the timeout
+        """
+        target = self.con.getCurrPosition() + dist
+        self.con.moveStage(dist)
+        if timeout_s is None:
+            timeout_s = 1. + 0.005*abs(dist)
+        t0 = time.perf_counter()
+        settled = False
+        while time.perf_counter() - t0 < timeout_s:
+            if abs(self.con.getCurrPosition() - target) < tol:
+                settled = True
+                break
+            sleep(0.02)
+        self.send_motion_event(dist)
+        # called from the block thread, the display belongs to the Tk thread
+        self.acuterig.call_in_tk(self.show_position, self.con.getCurrPosition())
+        return settled
+
+    def set_auto_stepping(self, auto_stepping):
+        # the block thread owns the serial connection while a depth search runs
+        self.auto_stepping = auto_stepping
+        state = DISABLED if auto_stepping else NORMAL
+        for button in (self.down5, self.down25, self.down50, self.up25, self.up50, self.up100,
+                       self.disableB, self.gohome, self.resetHomeB):
+            button.config(state=state)
+
     def update_position_display(self):
-        pos = self.con.getCurrPosition()
+        self.show_position(self.con.getCurrPosition())
+
+    def show_position(self, pos):
         self.zcoord = pos - self.initial_drive_position
         self.posString.set(str("{:.1f}".format(self.zcoord)))
 
@@ -304,6 +475,8 @@ class CONEXControl:
             self.disabled = True
 
     def process_key(self, event):
+        if self.auto_stepping:
+            return
         keybindings = {'KP_7': 25, 'KP_8': 50, 'KP_9': 100, 'KP_1': -5, 'KP_2': -25, 'KP_3': -50} #each keypad key korresponds to a distance to move the stage
         if event.keysym == 'KP_5':
             self.rethome()
@@ -316,6 +489,476 @@ class CONEXControl:
         elif event.keysym in keybindings.keys():
             self.move_stage(keybindings[event.keysym])
 
+class RollingBuffer:
+    """
+    Last `size` samples in a preallocated ring, with running sum/sum of squares
+    and histogram counts updated on every push, so adding a sample and reading
+    the stats costs the same after ten trials or ten thousand.
+    """
+
+    def __init__(self, size=256, lo=0., hi=1., nbins=20):
+        self.size = size
+        self.values = np.zeros(size)
+        self.n = 0
+        self.sum = 0.
+        self.sumsq = 0.
+        self.lo = lo
+        self.hi = hi
+        self.nbins = nbins
+        self.counts = np.zeros(nbins, dtype=int)
+
+    def bin_of(self, x):
+        i = int((x - self.lo) * self.nbins / (self.hi - self.lo))
+        return min(max(i, 0), self.nbins - 1)
+
+    def push(self, x):
+        i = self.n % self.size
+        if self.n >= self.size:
+            old = self.values[i]
+            self.sum -= old
+            self.sumsq -= old * old
+            self.counts[self.bin_of(old)] -= 1
+        self.values[i] = x
+        self.sum += x
+        self.sumsq += x * x
+        self.counts[self.bin_of(x)] += 1
+        self.n += 1
+        if self.n % self.size == 0:
+            # once per lap, drop the rounding error the running sums pick up
+            self.sum = self.values.sum()
+            self.sumsq = (self.values * self.values).sum()
+
+    def count(self):
+        return min(self.n, self.size)
+
+    def last(self):
+        return self.values[(self.n - 1) % self.size] if self.n else float('nan')
+
+    def mean(self):
+        return self.sum / self.count() if self.n else float('nan')
+
+    def std(self):
+        if not self.n:
+            return float('nan')
+        m = self.mean()
+        return np.sqrt(max(self.sumsq / self.count() - m * m, 0.))
+
+
+class DiskMonitor(threading.Thread):
+    """
+    Samples free space and write rate of the recording volume while a block runs.
+    Warns when the free space won't last until the block ends (or for min_free_s
+    of recording if there is no end) and when the volume is taking data much
+    slower than the recording produces it.
+    """
+    interval_s = 10.
+    min_free_s = 600.
+
+    def __init__(self, path, bytes_per_s, block_s=None):
+        threading.Thread.__init__(self)
+        self.daemon = True
+        self.path = path
+        self.bytes_per_s = bytes_per_s
+        self.block_s = block_s
+        self.stop_flag = threading.Event()
+        self.lock = threading.Lock()
+        self.free = shutil.disk_usage(path).free
+        self.write_rate = None
+        self.t_start = time.perf_counter()
+
+    def run(self):
+        t_last = time.perf_counter()
+        while not self.stop_flag.wait(self.interval_s):
+            free = shutil.disk_usage(self.path).free
+            now = time.perf_counter()
+            with self.lock:
+                self.write_rate = (self.free - free) / (now - t_last)
+                self.free = free
+            t_last = now
+
+    def stop(self):
+        self.stop_flag.set()
+
+    def warnings(self):
+        with self.lock:
+            warn = []
+            if self.block_s is None:
+                needed = self.min_free_s * self.bytes_per_s
+            else:
+                needed = max(self.block_s - (time.perf_counter() - self.t_start), 0.) * self.bytes_per_s
+            if self.free < needed:
+                warn.append('Disk fills in {:.0f} min'.format(self.free / self.bytes_per_s / 60.))
+            if self.write_rate is not None and self.write_rate < 0.5 * self.bytes_per_s:
+                warn.append('Disk writing {:.1f} MB/s, expected {:.1f}'.format(self.write_rate / 1e6, self.bytes_per_s / 1e6))
+            return warn
+
+    def status(self):
+        with self.lock:
+            rate = '-' if self.write_rate is None else '{:.1f}'.format(self.write_rate / 1e6)
+            return 'Disk: {:.1f} GB free, {} MB/s'.format(self.free / 1e9, rate)
+
+
+def read_text_events(path, pattern):
+    """
+    Open Ephys text events from the messages*.events files under path, read while or after recording
+    :param pattern: compiled regex matched against the event text
+    :return: list of (file suffix, sample, match) in file order, the suffix is '' or e.g. '_2'
+    """
+    found = []
+    for dirpath, _, filenames in os.walk(path):
+        for f in sorted(filenames):
+            if f.startswith('messages') and f.endswith('.events'):
+                with open(os.path.join(dirpath, f)) as events:
+                    for line in events:
+                        parts = line.strip().split(' ', 1)
+                        if len(parts) == 2 and parts[0].isdigit():
+                            match = pattern.match(parts[1].strip())
+                            if match:
+                                found.append((f[len('messages'):-len('.events')], int(parts[0]), match))
+    return found
+
+
+class RecordingSegmenter:
+    """
+    Splits a long recording into segments with OpenEphysEvents.break_rec once a
+    segment is older than max_segment_s or bigger than max_segment_bytes.
+    Breaks only happen in an ITI with room for one, so they never overlap a stimulus.
+
+    Every segment is bracketed by 'segment N start'/'segment N end' text events. Read back
+    from messages*.events they give its start/end sample, the Open Ephys file suffix it is in
+    and its recording number within those files. The gap between segments comes from
+    those samples: gap_samples_max spans the end event before StopRecord to the start event
+    after StartRecord, so it is an upper bound on the samples that were not recorded.
+    break_s_host_max is the same break timed on the host from the command round trips.
+    The segments and their trials are kept in segments.json in the block directory.
+    """
+    index_name = 'segments.json'
+    gap_margin_s = 0.25
+    event_line = re.compile(r'^segment (\d+) (start|end)$')
+
+    def __init__(self, openephys, block_path, rec_par, max_segment_s=None, max_segment_bytes=None,
+                 sample_rate=30000.):
+        self.openephys = openephys
+        self.block_path = block_path
+        self.rec_par = rec_par
+        self.max_segment_s = max_segment_s
+        self.max_segment_bytes = max_segment_bytes
+        self.sample_rate = sample_rate
+        # until a break has been measured assume it takes about a second
+        self.gap_estimate_s = 1.0
+        self.segments = []
+        self.bytes_before = 0
+        self.new_segment(break_s=None)
+
+    def new_segment(self, break_s):
+        self.t_segment = time.perf_counter()
+        self.segments.append({'segment': len(self.segments),
+                              'file_suffix': None,
+                              'recording': None,
+                              'start_sample': None,
+                              'end_sample': None,
+                              'gap_samples_max': None,
+                              'gap_s_max': None,
+                              'break_s_host_max': break_s,
+                              'start_time': datetime.datetime.now().isoformat(),
+                              'end_time': None,
+                              'trials': []})
+        self.mark('start')
+
+    def mark(self, what):
+        self.openephys.send_command('segment {} {}'.format(len(self.segments) - 1, what))
+
+    def end_segment(self):
+        self.mark('end')
+        self.segments[-1]['end_time'] = datetime.datetime.now().isoformat()
+
+    def recorded_bytes(self):
+        return directory_bytes(self.block_path)
+
+    def trial_done(self, trial_num, stimulus_file, pi_onset=None, underruns=None):
+        # pi_onset is on the pi clock, clock_sync.json maps it to samples
+        self.segments[-1]['trials'].append([int(trial_num), stimulus_file, datetime.datetime.now().isoformat(),
+                                            pi_onset, underruns])
+
+    def due(self):
+        if self.max_segment_s is not None and time.perf_counter() - self.t_segment > self.max_segment_s:
+            return True
+        if self.max_segment_bytes is not None and self.recorded_bytes() - self.bytes_before > self.max_segment_bytes:
+            return True
+        return False
+
+    def maybe_rotate(self, time_left_s):
+        """
+        Called from the ITI, after the stimulus has finished
+        :param time_left_s: time until the next trial starts
+        :return: True if a new segment was started
+        """
+        if time_left_s < self.gap_estimate_s + self.gap_margin_s or not self.due():
+            return False
+        bytes_before = self.recorded_bytes()
+        self.end_segment()
+        t0 = time.perf_counter()
+        if not self.openephys.break_rec(self.rec_par):
+            if self.openephys.query_status('Recording'):
+                # StopRecord did not take, a later end event for this segment replaces the one above
+                print('Could not start a new segment, still recording segment {}'.format(len(self.segments) - 1))
+                return False
+            print('Recording stopped in the break, starting it again')
+            if not self.openephys.start_rec(self.rec_par):
+                raise RuntimeError('Open Ephys stopped recording and did not start again')
+        break_s = time.perf_counter() - t0
+        self.gap_estimate_s = max(self.gap_estimate_s, break_s)
+        self.bytes_before = bytes_before
+        self.new_segment(break_s=break_s)
+        print('Started recording segment {} (break {:.3f} s)'.format(len(self.segments) - 1, break_s))
+        self.write_index()
+        return True
+
+    def resolve_samples(self):
+        # events are read back as Open Ephys flushes them, the last one of each kind wins
+        for suffix, sample, match in read_text_events(self.block_path, self.event_line):
+            n = int(match.group(1))
+            if n < len(self.segments):
+                self.segments[n][match.group(2) + '_sample'] = sample
+                self.segments[n]['file_suffix'] = suffix
+        # recording numbers count up within the files sharing a suffix
+        recordings = {}
+        for segment in self.segments:
+            if segment['file_suffix'] is not None:
+                segment['recording'] = recordings.get(segment['file_suffix'], 0)
+                recordings[segment['file_suffix']] = segment['recording'] + 1
+        for previous, segment in zip(self.segments[:-1], self.segments[1:]):
+            if previous['end_sample'] is not None and segment['start_sample'] is not None:
+                segment['gap_samples_max'] = segment['start_sample'] - previous['end_sample']
+                segment['gap_s_max'] = segment['gap_samples_max'] / self.sample_rate
+
+    def write_index(self):
+        self.resolve_samples()
+        with open(os.path.join(self.block_path, self.index_name), 'w') as f:
+            json.dump({'sample_rate': self.sample_rate, 'segments': self.segments}, f, indent=1)
+
+    def close(self):
+        # call write_index again once recording has stopped to pick up the last events
+        self.end_segment()
+        self.write_index()
+
+
+def fit_clock(x, y, half_widths, min_span_s=10., default_slope=0.):
+    """
+    Straight line fit y = offset + slope * (x - x0) through timed exchanges
+    :param x: host times (s) at the middle of each exchange
+    :param y: the other clock read during each exchange
+    :param half_widths: half the round trip of each exchange, in units of y
+    :param min_span_s: the slope is only fitted when the exchanges span at least this long,
+        a single burst lasts milliseconds and its slope is noise
+    :param default_slope: slope used when it is not fitted
+    :return: dictionary with x0, offset, slope and 95% bounds offset_ci, slope_ci
+        (None when the slope was not fitted). The bounds add the smallest half width,
+        the ambiguity no fit can remove.
+    """
+    x = np.asarray(x, dtype=float)
+    y = np.asarray(y, dtype=float)
+    x0 = x.mean()
+    floor = float(np.min(half_widths))
+    if len(x) < 4 or np.ptp(x) < min_span_s:
+        # too few points or too short to see drift
+        residual = y - default_slope * (x - x0)
+        return {'x0': x0, 'offset': float(np.mean(residual)), 'slope': default_slope,
+                'offset_ci': floor + 1.96 * float(np.std(residual)), 'slope_ci': None, 'n': len(x)}
+    (slope, offset), cov = np.polyfit(x - x0, y, 1, cov=True)
+    return {'x0': x0, 'offset': float(offset), 'slope': float(slope),
+            'offset_ci': floor + 1.96 * float(np.sqrt(cov[1, 1])),
+            'slope_ci': 1.96 * float(np.sqrt(cov[0, 0])), 'n': len(x)}
+
+
+class ClockSync:
+    """
+    Maps pi clock and Open Ephys sample clock onto host time.
+    Pi: NTP style exchanges with the pi's sync command, keeping the lowest delay
+    exchanges of each burst, offset = pi - host fitted against host time (slope is drift).
+    Open Ephys: 'sync N' text events are bracketed by host send/receive times and
+    read back with their sample numbers from messages*.events in the block directory.
+    The fits and the composed pi -> sample line are written to clock_sync.json.
+    """
+    burst = 8
+    keep = 4
+    file_name = 'clock_sync.json'
+    sync_line = re.compile(r'^sync (\d+)$')
+
+    def __init__(self, rpi, openephys=None, sample_rate=30000.):
+        self.rpi = rpi
+        self.openephys = openephys
+        # nominal rate, used until the marks span long enough to fit it
+        self.sample_rate = sample_rate
+        self.pi_exchanges = []  # (host mid time, pi - host, delay)
+        self.oe_marks = {}      # sync id: (host send, host receive)
+        self.t_last = None
+
+    def sync_pi(self):
+        exchanges = []
+        for _ in range(self.burst):
+            t0 = time.time()
+            name, params = self.rpi.send_command('sync')
+            t3 = time.time()
+            if name != 'sync':
+                raise RuntimeError('Pi did not answer sync: {} {}'.format(name, params))
+            t1, t2 = params['t_recv'], params['t_send']
+            exchanges.append(((t0 + t3) / 2., ((t1 - t0) + (t2 - t3)) / 2., (t3 - t0) - (t2 - t1)))
+        exchanges.sort(key=lambda e: e[2])
+        self.pi_exchanges.extend(exchanges[:self.keep])
+
+    def mark_openephys(self):
+        for _ in range(self.burst):
+            mark = len(self.oe_marks) + 1
+            t0 = time.time()
+            self.openephys.send_command('sync {}'.format(mark))
+            self.oe_marks[mark] = (t0, time.time())
+
+    def sync(self):
+        self.sync_pi()
+        if self.openephys is not None:
+            self.mark_openephys()
+        self.t_last = time.perf_counter()
+
+    def due(self, interval_s):
+        return self.t_last is None or time.perf_counter() - self.t_last > interval_s
+
+    def read_marks(self, path):
+        return {int(match.group(1)): sample for _, sample, match in read_text_events(path, self.sync_line)
+                if int(match.group(1)) in self.oe_marks}
+
+    def fit(self, path=None):
+        result = {'time': datetime.datetime.now().isoformat(), 'pi': None, 'openephys': None, 'pi_to_samples': None}
+        if self.pi_exchanges:
+            x, y, delay = zip(*self.pi_exchanges)
+            result['pi'] = fit_clock(x, y, np.array(delay) / 2.)
+        samples = self.read_marks(path) if path is not None else {}
+        if len(samples) >= 2:
+            marks = sorted(samples)
+            x = [sum(self.oe_marks[m]) / 2. for m in marks]
+            half = [(self.oe_marks[m][1] - self.oe_marks[m][0]) / 2. for m in marks]
+            oe = fit_clock(x, [samples[m] for m in marks], [0.], default_slope=self.sample_rate)
+            if oe['slope'] > 0.:
+                # the round trips are in host seconds, the slope turns them into samples
+                oe['offset_ci'] += oe['slope'] * min(half)
+                result['openephys'] = oe
+        pi, oe = result['pi'], result['openephys']
+        if pi is not None and oe is not None:
+            # host = (pi - offset + drift * x0) / (1 + drift), sample = offset + rate * (host - x0)
+            slope = oe['slope'] / (1. + pi['slope'])
+            result['pi_to_samples'] = {'intercept': oe['offset'] - oe['slope'] * oe['x0']
+                                                    + slope * (pi['slope'] * pi['x0'] - pi['offset']),
+                                       'slope': slope}
+        return result
+
+    def write(self, path):
+        result = self.fit(path)
+        with open(os.path.join(path, self.file_name), 'w') as f:
+            json.dump(result, f, indent=1)
+        return result
+
+
+class BlockTimingMonitor:
+    """
+    Per-trial timing of a running block, fed from the block thread and read by
+    the GUI. ITI actual is measured from the Pi's trial reply to the next trial
+    start. All times are seconds.
+    """
+    iti_warn_s = 0.1    # rolling mean ITI error
+    drift_warn_s = 2.0  # accumulated ITI error over the block
+    rtt_warn_s = 0.05   # rolling mean command round trip
+
+    def __init__(self, n_trials=None, window=256):
+        self.lock = threading.Lock()
+        self.n_trials = n_trials
+        self.iti_error = RollingBuffer(window, -0.25, 0.25)
+        self.pi_rtt = RollingBuffer(window, 0., 0.1)
+        self.oe_rtt = RollingBuffer(window, 0., 0.1)
+        self.period = RollingBuffer(window, 0., 60.)
+        self.t_start = time.time()
+        self.trials_done = 0
+        self.drift = 0.
+        self.last_start = None
+        self.last_end = None
+        self.scheduled_iti = None
+        self.actual_iti = None
+        self.underruns = 0
+        self.trials_with_underruns = 0
+        self.callback_max_ms = 0.
+
+    def trial_started(self):
+        now = time.perf_counter()
+        with self.lock:
+            if self.last_end is not None:
+                self.actual_iti = now - self.last_end
+                error = self.actual_iti - self.scheduled_iti
+                self.iti_error.push(error)
+                self.drift += error
+            if self.last_start is not None:
+                self.period.push(now - self.last_start)
+            self.last_start = now
+
+    def trial_finished(self, scheduled_iti):
+        with self.lock:
+            self.last_end = time.perf_counter()
+            self.scheduled_iti = scheduled_iti
+            self.trials_done += 1
+
+    def record_oe_rtt(self, rtt):
+        with self.lock:
+            self.oe_rtt.push(rtt)
+
+    def record_pi_rtt(self, rtt):
+        with self.lock:
+            self.pi_rtt.push(rtt)
+
+    def record_playback(self, reply):
+        # audio callback counters the pi sends back with each trial
+        with self.lock:
+            underruns = reply.get('underruns', 0)
+            self.underruns += underruns
+            self.trials_with_underruns += 1 if underruns else 0
+            self.callback_max_ms = max(self.callback_max_ms, reply.get('callback_max_ms', 0.))
+
+    def projected_end(self):
+        # wall clock time of the end of the block, None for search or before the second trial
+        if self.n_trials is None or not self.period.n:
+            return None
+        remaining = max(self.n_trials - self.trials_done, 0)
+        elapsed = time.time() - self.t_start
+        return datetime.datetime.fromtimestamp(self.t_start + elapsed + remaining * self.period.mean())
+
+    def warnings(self):
+        warn = []
+        if abs(self.iti_error.mean()) > self.iti_warn_s:
+            warn.append('ITI off by {:+.0f} ms'.format(1000 * self.iti_error.mean()))
+        if abs(self.drift) > self.drift_warn_s:
+            warn.append('Block drifted {:+.1f} s'.format(self.drift))
+        if self.pi_rtt.mean() > self.rtt_warn_s:
+            warn.append('Pi slow ({:.0f} ms)'.format(1000 * self.pi_rtt.mean()))
+        if self.oe_rtt.mean() > self.rtt_warn_s:
+            warn.append('OE slow ({:.0f} ms)'.format(1000 * self.oe_rtt.mean()))
+        if self.underruns:
+            warn.append('Pi underruns: {} in {} trials'.format(self.underruns, self.trials_with_underruns))
+        return warn
+
+    def snapshot(self):
+        with self.lock:
+            return {'scheduled_iti': self.scheduled_iti,
+                    'actual_iti': self.actual_iti,
+                    'iti_error': self.iti_error.mean(),
+                    'drift': self.drift,
+                    'pi_rtt': self.pi_rtt.last(),
+                    'pi_rtt_mean': self.pi_rtt.mean(),
+                    'oe_rtt': self.oe_rtt.last(),
+                    'oe_rtt_mean': self.oe_rtt.mean(),
+                    'end': self.projected_end(),
+                    'warnings': self.warnings(),
+                    'histograms': [('ITI err', self.iti_error.counts.copy()),
+                                   ('Pi RTT', self.pi_rtt.counts.copy()),
+                                   ('OE RTT', self.oe_rtt.counts.copy())]}
+
+
 class AcuteExperimentControl:
 
     def __init__(self, master):
@@ -328,6 +971,8 @@ class AcuteExperimentControl:
         self.ML = 0
         self.Z = 0
         self.probe = 'A1x16'
+        self.n_extra_channels = 8 # aux and adc channels recorded with the probe
+        self.sample_rate = 30000.
 
         # Stimulu information
         self.stim_dir = os.path.expanduser('~/stimuli/')
@@ -337,8 +982,28 @@ class AcuteExperimentControl:
         self.inter_trial_max = 5.0
         self.inter_trial_min = 2.0
         self.inter_trial_fixed = 5.0
+
+        # Recording segments, None turns a limit off
+        self.segment_max_s = 30 * 60.
+        self.segment_max_bytes = 4 * 1024**3
+
+        # Disk preflight: refuse below 1x the needed space/throughput, ask below the margin
+        self.disk_space_margin = 1.5
+        self.disk_rate_margin = 3.
+        self.search_preflight_s = 3600. # search has no end, check for this long
+        self.disk_monitor = None
+
+        # Clock sync bursts during blocks
+        self.sync_interval_s = 60.
         self.n_repeats = 1
 
+        # Depth search: step the CONEX drive between groups of search trials
+        self.depth_step_um = 25.
+        self.depth_trials = 20
+        self.depth_steps = 10
+        self.depth_settle_s = 0.5
+        self.conex_app = None
+
         # Command Protocol
         self.rpi_port = 5556
         self.oe_port = 5558
@@ -347,7 +1012,11 @@ class AcuteExperimentControl:
         self.blocknum = 0
         self.search_or_block = "block"
         self.repeat_stim = False
-        self.setup_gui()
+        self.timing = None
+        with timed('gui'):
+            self.setup_gui()
+        with timed('logo'):
+            self.setup_logo()
 
     def setup_gui(self):
         # Bird / Probe / Location
@@ -397,6 +1066,7 @@ class AcuteExperimentControl:
         self.sob.set("block")
         self.search_button = Radiobutton(self.block_labelframe, text="Search", variable=self.sob, value="search", command=self.set_search)
         self.block_button = Radiobutton(self.block_labelframe, text="Block", variable=self.sob, value="block", command=self.set_block)
+        self.depth_button = Radiobutton(self.block_labelframe, text="Depth Search", variable=self.sob, value="depth", command=self.set_depth_search)
 
         self.iti_range_label = Label(self.block_labelframe, text="ITI Min (s)")
         self.iti_range_min_entry = Entry(self.block_labelframe, width=4, justify='right')
@@ -407,6 +1077,13 @@ class AcuteExperimentControl:
         self.n_repeats_entry = Entry(self.block_labelframe, width=4, justify='right')
         self.repeat_stimulus_button = Button(self.block_labelframe, text='Repeat Stimulus', command=self.flip_repeat_stimulus)
 
+        self.depth_step_label = Label(self.block_labelframe, text='Depth Step (um)')
+        self.depth_step_entry = Entry(self.block_labelframe, width=4, justify='right')
+        self.depth_trials_label = Label(self.block_labelframe, text='Trials/Depth')
+        self.depth_trials_entry = Entry(self.block_labelframe, width=4, justify='right')
+        self.depth_steps_label = Label(self.block_labelframe, text='Depths')
+        self.depth_steps_entry = Entry(self.block_labelframe, width=4, justify='right')
+
         self.iti_label.grid(row=0, column=0, columnspan=2)
         self.random_iti_button.grid(row=1, column=0) 
         self.fixed_iti_button.grid(row=1, column=1)
@@ -421,12 +1098,22 @@ class AcuteExperimentControl:
         self.n_repeats_label.grid(row=6, column=0)
         self.n_repeats_entry.grid(row=6, column=1)
         self.repeat_stimulus_button.grid(row=7, column=0, columnspan=2)
+        self.depth_button.grid(row=8, column=0, columnspan=2)
+        self.depth_step_label.grid(row=9, column=0)
+        self.depth_step_entry.grid(row=9, column=1)
+        self.depth_trials_label.grid(row=10, column=0)
+        self.depth_trials_entry.grid(row=10, column=1)
+        self.depth_steps_label.grid(row=11, column=0)
+        self.depth_steps_entry.grid(row=11, column=1)
 
         self.block_labelframe.grid(row=2, column=0, rowspan=3,columnspan=4, padx=5, sticky=W+E+N+S)
 
         self.n_repeats_entry.insert(0, str(self.n_repeats))
         self.iti_range_min_entry.insert(0, str(self.inter_trial_min))
         self.iti_range_max_entry.insert(0, str(self.inter_trial_max))
+        self.depth_step_entry.insert(0, str(self.depth_step_um))
+        self.depth_trials_entry.insert(0, str(self.depth_trials))
+        self.depth_steps_entry.insert(0, str(self.depth_steps))
         
 
         # Stimulus Path
@@ -467,23 +1154,81 @@ class AcuteExperimentControl:
         self.block_max_label = Label(self.block_status_frame, text = "Block Max: %.1f (s)" % 0)
         self.stimulus_status_label = Label(self.block_status_frame, text='No Stimuli')
         self.stimulus_status_label.grid(row=1, column=0, columnspan = 4, sticky='W')
+        self.prep_status_label = Label(self.block_status_frame, text='')
+        self.prep_status_label.grid(row=2, column=0, columnspan = 4, sticky='W')
         self.block_min_label.grid(row=0, column=0, columnspan=1)
         self.block_max_label.grid(row=0, column=1, columnspan=1)
 
         self.block_status_frame.grid(row=3, column=4, columnspan=4, rowspan=1, padx=5, pady=5, sticky=N+S+E+W)
 
-        # Logo
-        image = Image.open("glab.png").resize(size=(256, 64), resample=Image.BICUBIC)
-        self.logo = ImageTk.PhotoImage(image)
-        self.logo_label = Label(image=self.logo)
-        self.logo_label.grid(row=0, column=4, columnspan=4, rowspan=2, pady=15, padx=10, sticky=N+S)
+        # Block Timing
+        self.timing_frame = LabelFrame(self.master_window, bd=2, relief='ridge', text="Block Timing")
+        self.iti_timing_label = Label(self.timing_frame, text="ITI: -", anchor=W)
+        self.rtt_timing_label = Label(self.timing_frame, text="RTT: -", anchor=W)
+        self.end_timing_label = Label(self.timing_frame, text="Projected End: -", anchor=W)
+        self.timing_warning_label = Label(self.timing_frame, text="", fg='red', anchor=W)
+        self.timing_canvas = Canvas(self.timing_frame, width=480, height=70)
+        self.iti_timing_label.grid(row=0, column=0, sticky=W)
+        self.rtt_timing_label.grid(row=1, column=0, sticky=W)
+        self.end_timing_label.grid(row=2, column=0, sticky=W)
+        self.timing_warning_label.grid(row=3, column=0, sticky=W)
+        self.disk_label = Label(self.timing_frame, text="Disk: -", anchor=W)
+        self.disk_label.grid(row=2, column=1, sticky=W)
+        self.timing_canvas.grid(row=4, column=0)
+        self.timing_frame.grid(row=5, column=0, columnspan=8, padx=5, pady=5, sticky=W+E)
+        self.master_window.after(500, self.refresh_timing_panel)
 
         # Author
         #Label(self.master_window, text="Brad Theilman").grid(row=11, column=4 )
 
         # Setup Session button
 
+    def refresh_timing_panel(self):
+        # polled from the Tk loop, the block thread only pushes samples into self.timing
+        if self.timing is not None:
+            snap = self.timing.snapshot()
+            if snap['actual_iti'] is not None:
+                self.iti_timing_label.config(text="ITI: {:.2f} s actual / {:.2f} s scheduled   mean err {:+.0f} ms   drift {:+.2f} s".format(
+                    snap['actual_iti'], snap['scheduled_iti'], 1000 * snap['iti_error'], snap['drift']))
+            self.rtt_timing_label.config(text="RTT Pi: {:.1f} ms (mean {:.1f})   OE: {:.1f} ms (mean {:.1f})".format(
+                1000 * snap['pi_rtt'], 1000 * snap['pi_rtt_mean'], 1000 * snap['oe_rtt'], 1000 * snap['oe_rtt_mean']))
+            end = snap['end'].strftime('%H:%M:%S') if snap['end'] else '-'
+            self.end_timing_label.config(text="Projected End: {}".format(end))
+            warnings = snap['warnings']
+            if self.disk_monitor is not None:
+                self.disk_label.config(text=self.disk_monitor.status())
+                warnings = warnings + self.disk_monitor.warnings()
+            self.timing_warning_label.config(text='   '.join(warnings))
+            self.draw_histograms(snap['histograms'])
+        self.master_window.after(500, self.refresh_timing_panel)
+
+    def draw_histograms(self, histograms):
+        self.timing_canvas.delete('all')
+        width = int(self.timing_canvas['width']) // len(histograms)
+        height = int(self.timing_canvas['height']) - 15
+        for k, (name, counts) in enumerate(histograms):
+            x0 = k * width + 5
+            bar = (width - 10) / float(len(counts))
+            top = max(counts.max(), 1)
+            for i, c in enumerate(counts):
+                h = height * c / float(top)
+                self.timing_canvas.create_rectangle(x0 + i * bar, height - h, x0 + (i + 1) * bar, height, fill='#00aa33', width=0)
+            self.timing_canvas.create_text(x0 + (width - 10) / 2., height + 8, text=name)
+
+    def setup_logo(self):
+        self.logo = load_logo()
+        if self.logo is not None:
+            self.logo_label = Label(image=self.logo)
+        else:
+            self.logo_label = Label(text='Gentnerlab')
+        self.logo_label.grid(row=0, column=4, columnspan=4, rowspan=2, pady=15, padx=10, sticky=N+S)
+
     def open_conex(self):
+        try:
+            lazy_import('conex', 'serial_commander.conex_interface')
+        except ImportError as e:
+            messagebox.showerror('CONEX Control', 'CONEX package not available: {}'.format(e))
+            return
         self.conex_window = Toplevel(self.master_window)
         self.conex_app = CONEXControl(self)
 
@@ -501,6 +1246,9 @@ class AcuteExperimentControl:
             self.inter_trial_min = float(self.iti_range_min_entry.get())
         else:
             self.inter_trial_fixed = float(self.iti_range_min_entry.get())
+        self.depth_step_um = float(self.depth_step_entry.get())
+        self.depth_trials = int(self.depth_trials_entry.get())
+        self.depth_steps = int(self.depth_steps_entry.get())
         self.stim_dir = self.stimulus_path_entry.get()
         print('Bird: {} Probe: {} AP: {} ML: {} Z:{}'.format(self.bird, self.probe, self.AP, self.ML, self.Z))
         self.start_block()
@@ -508,8 +1256,21 @@ class AcuteExperimentControl:
     def stop_button_cmd(self):
         if self.run_block_flag:
             self.run_block_flag.clear()
-        self.unlock_params()
-    
+            # the block thread waits in start_trial until the stimulus ends, cut it short from a second connection
+            threading.Thread(target=self.abort_pi_trial, daemon=True).start()
+        # the block thread unlocks the parameters once it has cleaned up
+
+    def abort_pi_trial(self):
+        rpi = RigStateMachineConnection(timeout_s=5.)
+        rpi.connect()
+        try:
+            _, reply = rpi.abort()
+            print('Aborted {} trial(s) on the pi'.format(reply.get('n', 0)))
+        except zmq.ZMQError as e:
+            print('Could not abort on the pi: {}'.format(e))
+        finally:
+            rpi.close()
+
     def flip_repeat_stimulus(self):
         self.repeat_stim = not self.repeat_stim
         if self.repeat_stim:
@@ -519,6 +1280,7 @@ class AcuteExperimentControl:
 
 
     def lock_params(self):
+        self.start_button.config(state=DISABLED)
         self.bird_entry.config(state=DISABLED)
         self.probe_entry.config(state=DISABLED)
         self.ap_entry.config(state=DISABLED)
@@ -527,8 +1289,12 @@ class AcuteExperimentControl:
         self.n_repeats_entry.config(state=DISABLED)
         self.iti_range_max_entry.config(state=DISABLED)
         self.iti_range_min_entry.config(state=DISABLED)
+        self.depth_step_entry.config(state=DISABLED)
+        self.depth_trials_entry.config(state=DISABLED)
+        self.depth_steps_entry.config(state=DISABLED)
 
     def unlock_params(self):
+        self.start_button.config(state=NORMAL)
         self.bird_entry.config(state=NORMAL)
         self.probe_entry.config(state=NORMAL)
         self.ap_entry.config(state=NORMAL)
@@ -537,6 +1303,9 @@ class AcuteExperimentControl:
         self.n_repeats_entry.config(state=NORMAL)
         self.iti_range_max_entry.config(state=NORMAL)
         self.iti_range_min_entry.config(state=NORMAL)
+        self.depth_step_entry.config(state=NORMAL)
+        self.depth_trials_entry.config(state=NORMAL)
+        self.depth_steps_entry.config(state=NORMAL)
 
     def set_random_iti(self):
         self.inter_trial_type='random'
@@ -554,115 +1323,386 @@ class AcuteExperimentControl:
     def set_block(self):
         self.search_or_block = "block"
 
+    def set_depth_search(self):
+        self.search_or_block = "depth"
+
     def start_block(self):
-        # Connect to Raspberry pi
-        self.rpi = RigStateMachineConnection()
-        self.rpi.connect()
+        # Preparation runs on the block thread so the window stays responsive,
+        # the block itself follows on the same thread once the rig is ready.
+        # The thread keeps its own flag, Stop clears the one of the current block.
+        run_flag = threading.Event()
+        run_flag.set()
+        self.run_block_flag = run_flag
+        self.block_thread = threading.Thread(target=self.prepare_and_run_block, args=(run_flag,))
+        self.block_thread.start()
 
-        # Connect to OpenEphys
+    def prepare_and_run_block(self, run_flag):
+        self.t_prep = time.perf_counter()
+        try:
+            ready = self.prepare_block(run_flag)
+        except Exception as e:
+            print('Block preparation failed: {}'.format(e))
+            self.call_in_tk(messagebox.showerror, 'Block preparation', str(e))
+            ready = False
+        if not ready:
+            self.abort_preparation()
+            return
+        # whatever stops the block, recording and the disk monitor are stopped and Start comes back
+        status_text = "Block Failed"
+        try:
+            if self.search_or_block == "block":
+                status_text = self.block_thread_task(run_flag)
+            elif self.search_or_block == "depth":
+                status_text = self.depth_search_thread_task(run_flag)
+            else:
+                status_text = self.search_thread_task(run_flag)
+        except Exception as e:
+            print('Block stopped: {}'.format(e))
+            self.call_in_tk(messagebox.showerror, 'Block', str(e))
+        finally:
+            self.finish_block(status_text)
+
+    def set_prep_status(self, stage):
+        text = '{} ({:.1f} s)'.format(stage, time.perf_counter() - self.t_prep)
+        print('Block preparation: ' + text)
+        self.prep_status_label.config(text=text)
+
+    def prepare_block(self, run_flag):
+        """
+        Stages that don't depend on each other overlap: Open Ephys is connected and
+        starts acquiring on its own thread while stimuli are prepared and uploaded.
+        :return: True once recording is running and the pi answers, False if stopped or refused
+        """
+        self.rpi = None
+        self.disk_monitor = None
         self.openephys = OpenEphysEvents()
-        self.openephys.connect()
-
-        # Load Stimuli
-        self.stimuli=['./test.wav', './test.wav', './test.wav']
-        self.load_stimuli(self.stim_dir)
-
-        # Add Sines to Stimuli
-        self.add_sines_to_stimuli()
-
-        # Compute Length
-        (block_min, block_max) = self.compute_block_length()
-        self.block_min_label.config(text="Block Min: %.1f (s)" % block_min)
-        self.block_max_label.config(text="Block Max: %.1f (s)" % block_max)
-
-        # Copy Stimuli
-        self.copy_stimuli()
-        print('Copied stimuli.')
-
-        # prepare the block
+        if self.search_or_block == "depth" and self.conex_app is None:
+            raise RuntimeError('Open Conex Control before starting a depth search')
+        self.acquiring = False
+        acq_thread = threading.Thread(target=self.warm_up_acquisition)
+        acq_thread.start()
+
+        try:
+            # Load Stimuli
+            self.set_prep_status('Preparing stimuli')
+            self.stimuli=['./test.wav', './test.wav', './test.wav']
+            self.load_stimuli(self.stim_dir)
+
+            # Add Sines to Stimuli
+            self.add_sines_to_stimuli()
+
+            # Compute Length
+            (block_min, block_max) = self.compute_block_length()
+            self.block_min_label.config(text="Block Min: %.1f (s)" % block_min)
+            self.block_max_label.config(text="Block Max: %.1f (s)" % block_max)
+
+            # Check the disk can hold and keep up with the recording
+            self.set_prep_status('Checking disk')
+            block_s = block_max if self.search_or_block == "block" else None
+            if not self.disk_preflight(block_s) or not run_flag.is_set():
+                return False
+
+            # Connect to Raspberry pi and copy stimuli
+            self.set_prep_status('Uploading stimuli')
+            self.rpi = RigStateMachineConnection()
+            self.rpi.connect()
+            self.copy_stimuli()
+            print('Copied stimuli.')
+            self.rpi.ping()
+            self.clock_sync = ClockSync(self.rpi, self.openephys, self.sample_rate)
+        finally:
+            acq_thread.join()
+
+        self.set_prep_status('Waiting for acquisition')
+        if not self.acquiring:
+            raise RuntimeError('Open Ephys is not acquiring')
+        if not run_flag.is_set():
+            return False
+
+        # Start Recording
+        self.set_prep_status('Starting recording')
         self.blocknum += 1
         self.setup_block_name(self.search_or_block)
-        if self.search_or_block == "block":
-            self.block_thread = threading.Thread(target=self.block_thread_task)
-        else:
-            self.block_thread = threading.Thread(target=self.search_thread_task)
-        self.run_block_flag = threading.Event()
-        self.run_block_flag.set()
-
-        # Start Recording and Run the block
-        self.openephys.start_acq()
         rec_params = {'CreateNewDir': '0', 'RecDir': self.block_path, 'PrependText': None, 'AppendText': None}
-        self.openephys.start_rec(rec_params)
-        time.sleep(5.0)
-        self.block_thread.start()
+        if not self.openephys.start_rec(rec_params):
+            raise RuntimeError('Open Ephys did not start recording')
+        self.disk_monitor = DiskMonitor(self.blocks_path, self.recording_bytes_per_s(), block_s)
+        self.disk_monitor.start()
+        self.segmenter = RecordingSegmenter(self.openephys, self.block_path, rec_params,
+                                            self.segment_max_s, self.segment_max_bytes, self.sample_rate)
+        self.set_prep_status('Waiting for recording data')
+        if not self.wait_for_recording():
+            print('No recording data in {} yet, starting anyway'.format(self.block_path))
+        # Open Ephys only writes sync events while recording
+        self.set_prep_status('Syncing clocks')
+        self.clock_sync.sync()
+        self.set_prep_status('Ready')
+        return True
+
+    def warm_up_acquisition(self):
+        try:
+            self.openephys.connect()
+            self.openephys.start_acq()
+            self.acquiring = bool(self.openephys.query_status('Acquiring'))
+        except zmq.ZMQError as e:
+            print('Open Ephys: {}'.format(e))
+
+    def wait_for_recording(self, timeout_s=10.):
+        # ready once Open Ephys has data in the block directory and it keeps growing
+        last = 0
+        t0 = time.perf_counter()
+        while time.perf_counter() - t0 < timeout_s:
+            size = directory_bytes(self.block_path)
+            if 0 < last < size:
+                return True
+            last = size
+            time.sleep(0.2)
+        return False
+
+    def abort_preparation(self):
+        self.set_prep_status('Block not started')
+        if self.rpi is not None:
+            self.rpi.close()
+        if self.openephys.context is not None:
+            try:
+                self.openephys.close()
+            except zmq.ZMQError:
+                self.openephys.context.destroy()
+        if self.disk_monitor is not None:
+            self.disk_monitor.stop()
+            self.disk_monitor = None
+        self.unlock_params()
 
-    def block_thread_task(self):
+    def call_in_tk(self, func, *args, **kwargs):
+        """
+        Run func on the Tk thread and wait for its result, for dialogs needed by worker threads
+        :return: what func returned, None if it raised
+        """
+        done = threading.Event()
+        result = []
+
+        def run():
+            try:
+                result.append(func(*args, **kwargs))
+            finally:
+                done.set()
+        self.master_window.after(0, run)
+        done.wait()
+        return result[0] if result else None
+
+    def draw_iti(self):
+        if self.inter_trial_type == 'random':
+            return (self.inter_trial_max - self.inter_trial_min)*np.random.random() + self.inter_trial_min
+        return self.inter_trial_fixed
+
+    def run_trial(self, stimulus_file, pi_stimulus_path, trial_num, iti, iti_task=None):
+        """
+        :param iti_task: optional function(time_left_s) run first thing in the ITI after the stimulus
+        """
+        self.timing.trial_started()
+        # Send Stimulus Name to OpenEphys
+        t0 = time.perf_counter()
+        self.openephys.send_command('stim ' + stimulus_file)
+        self.timing.record_oe_rtt(time.perf_counter() - t0)
+        # Tell RPi to run trial
+        _, reply = self.rpi.start_trial(pi_stimulus_path, trial_num)
+        self.timing.trial_finished(iti)
+        t_end = time.perf_counter()
+        self.timing.record_playback(reply)
+        self.segmenter.trial_done(trial_num, stimulus_file, reply.get('t_onset'), reply.get('underruns'))
+        print('ITI: {} seconds'.format(iti))
+        if iti_task is not None:
+            iti_task(iti - (time.perf_counter() - t_end))
+        # the pi is idle during the ITI, so its round trip is measured here
+        t0 = time.perf_counter()
+        self.rpi.ping()
+        self.timing.record_pi_rtt(time.perf_counter() - t0)
+        self.segmenter.maybe_rotate(iti - (time.perf_counter() - t_end))
+        if self.clock_sync.due(self.sync_interval_s) and iti - (time.perf_counter() - t_end) > 1.:
+            self.clock_sync.sync()
+            self.clock_sync.write(self.block_path)
+        time.sleep(max(iti - (time.perf_counter() - t_end), 0.))
+
+    def block_thread_task(self, run_flag):
         n_stims = len(self.stimuli)
         stim_order = np.tile(np.arange(n_stims), self.n_repeats)
         np.random.shuffle(stim_order)
+        self.timing = BlockTimingMonitor(n_trials=len(stim_order))
         #print(stim_order)
         for trial_num, stim_num in enumerate(stim_order):
             # check to see if we need to stop
-            if not self.run_block_flag.is_set():
+            if not run_flag.is_set():
                 break
 
-            if self.inter_trial_type == 'random':
-                iti = (self.inter_trial_max - self.inter_trial_min)*np.random.random() + self.inter_trial_min
-            else:
-                iti = self.inter_trial_fixed
+            iti = self.draw_iti()
             stimulus_file = self.stimuli[stim_num]
             _, stimulus_name = os.path.split(stimulus_file)
             pi_stimulus_path = os.path.join('/home/pi/stimuli/', stimulus_name)
             print('Trial: {} Stimulus: {}'.format(trial_num, stimulus_file))
             # set stimulus status label
             self.stimulus_status_label.config(text="Stimulus: {}   {} of {}".format(stimulus_name, trial_num+1, len(stim_order)))
-            # Send Stimulus Name to OpenEphys
-            self.openephys.send_command('stim ' + stimulus_file)
-            # Tell RPi to run trial
-            self.rpi.start_trial(pi_stimulus_path, trial_num)
-            print('ITI: {} seconds'.format(iti))
-            time.sleep(iti)
-
-        # clean up end of block
-        self.openephys.close()
-        self.unlock_params()
-        self.stimulus_status_label.config(text="Block Finished")
-
-    def search_thread_task(self):
-        n_stims = len(self.stimuli)
+            self.run_trial(stimulus_file, pi_stimulus_path, trial_num, iti)
+
+        return "Block Finished"
+
+    def search_trial(self, trial_num, stimulus_file, where='', iti_task=None):
+        """
+        Run one search trial
+        :param stimulus_file: stimulus of the previous trial, played again if repeat stimulus is set
+        :param where: text shown ahead of the stimulus in the log and the status label
+        :param iti_task: passed on to run_trial
+        :return: the stimulus that was played
+        """
+        # is repeat stimulus set?  if not, choose a new stimulus to play
+        if not self.repeat_stim:
+            stimulus_file = self.stimuli[np.random.randint(len(self.stimuli))]
+
+        iti = self.draw_iti()
+        _, stimulus_name = os.path.split(stimulus_file)
+        pi_stimulus_path = os.path.join('/home/pi/stimuli/', stimulus_name)
+        print('Search Trial: {} {}Stimulus: {}'.format(trial_num, where, stimulus_file))
+        # set stimulus status label
+        self.stimulus_status_label.config(text="{}Stimulus: {}".format(where, stimulus_name))
+        self.run_trial(stimulus_file, pi_stimulus_path, trial_num, iti, iti_task)
+        return stimulus_file
+
+    def search_thread_task(self, run_flag):
         stimulus_file = self.stimuli[0]
         trial_num = 0
-        while self.run_block_flag.is_set():
+        self.timing = BlockTimingMonitor()
+        while run_flag.is_set():
             trial_num += 1
-         # is repeat stimulus set?  if not, choose a new stimulus to play
-            if not self.repeat_stim:
-                stimulus_file = self.stimuli[np.random.randint(n_stims)]
+            stimulus_file = self.search_trial(trial_num, stimulus_file)
 
-            if self.inter_trial_type == 'random':
-                iti = (self.inter_trial_max - self.inter_trial_min)*np.random.random() + self.inter_trial_min
-            else:
-                iti = self.inter_trial_fixed
-            _, stimulus_name = os.path.split(stimulus_file)
-            pi_stimulus_path = os.path.join('/home/pi/stimuli/', stimulus_name)
-            print('Search Trial: {} Stimulus: {}'.format(trial_num, stimulus_file))
-            # set stimulus status label
-            self.stimulus_status_label.config(text="Stimulus: {}".format(stimulus_name))
-            # Send Stimulus Name to OpenEphys
-            self.openephys.send_command('stim ' + stimulus_file)
-            self.rpi.start_trial(pi_stimulus_path, trial_num)
-            print('ITI: {} seconds'.format(iti))
-            time.sleep(iti)
-
-        # clean up end of block
-        self.openephys.close()
-        self.unlock_params()
-        self.stimulus_status_label.config(text="Search Finished")
+        return "Search Finished"
+
+    def depth_search_thread_task(self, run_flag):
+        # search trials at a series of depths, each depth recorded into its own block
+        stimulus_file = self.stimuli[0]
+        trial_num = 0
+        self.timing = BlockTimingMonitor(n_trials=self.depth_steps * self.depth_trials)
+        # Conex Control can't be closed while auto_stepping, keep our own reference anyway
+        self.depth_conex = self.conex_app
+        self.depth_start_Z = self.Z
+        self.depth_start_zcoord = self.depth_conex.zcoord
+        self.call_in_tk(self.depth_conex.set_auto_stepping, True)
+
+        def step_if_running(time_left_s):
+            if run_flag.is_set():
+                self.step_depth(time_left_s)
+
+        try:
+            for depth in range(self.depth_steps):
+                for k in range(self.depth_trials):
+                    if not run_flag.is_set():
+                        break
+                    trial_num += 1
+                    # the drive moves in the ITI after the last trial at this depth
+                    last_at_depth = k == self.depth_trials - 1 and depth < self.depth_steps - 1
+                    where = 'Z {:.0f}  {} of {}  '.format(self.Z, k + 1, self.depth_trials)
+                    stimulus_file = self.search_trial(trial_num, stimulus_file, where,
+                                                      iti_task=step_if_running if last_at_depth else None)
+        finally:
+            self.call_in_tk(self.depth_conex.set_auto_stepping, False)
+        return "Depth Search Finished"
+
+    def step_depth(self, time_left_s):
+        """
+        Move the drive one depth step and carry on recording into a new block named with the new Z.
+        Runs in the ITI, whatever it takes beyond time_left_s delays the next trial.
+        """
+        t0 = time.perf_counter()
+        if not self.depth_conex.step_and_settle(self.depth_step_um):
+            print('Drive did not settle, recording anyway at {:.1f} um'.format(self.depth_conex.zcoord))
+        if self.depth_settle_s:
+            sleep(self.depth_settle_s)
+        self.Z = self.depth_start_Z + self.depth_conex.zcoord - self.depth_start_zcoord
+        self.call_in_tk(self.show_z)
+
+        # close the segment at the old depth, its sync events go in before the break
+        old_block_path = self.block_path
+        old_segmenter = self.segmenter
+        old_segmenter.close()
+        self.clock_sync.sync()
+        self.blocknum += 1
+        self.setup_block_name(self.search_or_block)
+        rec_params = {'CreateNewDir': '0', 'RecDir': self.block_path, 'PrependText': None, 'AppendText': None}
+        if not self.openephys.break_rec(rec_params):
+            raise RuntimeError('Open Ephys did not restart recording at Z {:.0f}'.format(self.Z))
+        self.clock_sync.write(old_block_path)
+        old_segmenter.write_index()
+        self.segmenter = RecordingSegmenter(self.openephys, self.block_path, rec_params,
+                                            self.segment_max_s, self.segment_max_bytes, self.sample_rate)
+        self.clock_sync.sync()
+        elapsed = time.perf_counter() - t0
+        print('Z {:.0f}: step took {:.2f} s, {:.2f} s past the ITI, break at most {:.3f} s'.format(
+            self.Z, elapsed, max(elapsed - time_left_s, 0.), self.openephys.last_break_s))
+
+    def show_z(self):
+        # the entry is locked during the block
+        self.z_entry.config(state=NORMAL)
+        self.z_entry.delete(0, END)
+        self.z_entry.insert(0, '{:.0f}'.format(self.Z))
+        self.z_entry.config(state=DISABLED)
+
+    def finish_block(self, status_text):
+        # clean up end of block, Open Ephys or the pi may be why the block stopped
+        self.disk_monitor.stop()
+        self.disk_monitor = None
+        try:
+            try:
+                self.segmenter.close()
+                self.clock_sync.sync()
+            except (zmq.ZMQError, RuntimeError) as e:
+                print('Could not mark the end of the block: {}'.format(e))
+            try:
+                self.openephys.close()
+            except zmq.ZMQError as e:
+                print('Open Ephys did not stop cleanly: {}'.format(e))
+                self.openephys.context.destroy()
+            # read back after recording stops so the sync and segment events are on disk
+            self.clock_sync.write(self.block_path)
+            self.segmenter.write_index()
+        finally:
+            self.unlock_params()
+            self.stimulus_status_label.config(text=status_text)
+
+    def n_channels(self):
+        # probe names are A<shanks>x<sites per shank>
+        match = re.search(r'(\d+)x(\d+)', self.probe)
+        n_probe = int(match.group(1)) * int(match.group(2)) if match else 32
+        return n_probe + self.n_extra_channels
+
+    def recording_bytes_per_s(self):
+        # int16 samples, plus the 22 byte header on every 1024 sample record of a .continuous file
+        return self.n_channels() * self.sample_rate * 2 * (2048 + 22) / 2048.
+
+    def disk_preflight(self, block_s):
+        """
+        Predict the bytes the block will record and probe the write rate of the blocks volume
+        :param block_s: maximum block duration, None for search
+        :return: True if the block can start
+        """
+        bytes_per_s = self.recording_bytes_per_s()
+        needed = bytes_per_s * (self.search_preflight_s if block_s is None else block_s)
+        free = shutil.disk_usage(self.blocks_path).free
+        rate = probe_write_throughput(self.blocks_path)
+        report = 'Need {:.2f} GB at {:.1f} MB/s, have {:.2f} GB free at {:.1f} MB/s'.format(
+            needed / 1e9, bytes_per_s / 1e6, free / 1e9, rate / 1e6)
+        print('Disk preflight: ' + report)
+        if free < needed or rate < bytes_per_s:
+            self.call_in_tk(messagebox.showerror, 'Disk preflight', 'Not starting the block.\n' + report)
+            return False
+        if free < self.disk_space_margin * needed or rate < self.disk_rate_margin * bytes_per_s:
+            return self.call_in_tk(messagebox.askyesno, 'Disk preflight', 'Disk is close to its limit.\n' + report + '\nStart anyway?', icon='warning')
+        return True
 
     def load_stimuli(self, path):
         wavfs = glob.glob(os.path.join(path, '*.wav'))
         self.stimuli = wavfs
     
     def add_sines_to_stimuli(self):
+        wavfile = lazy_import('stimulus prep', 'scipy.io.wavfile')
         if self.stimuli:
             self.sined_stim_names = []
             for stim in self.stimuli:
@@ -720,20 +1760,42 @@ class AcuteExperimentControl:
 
         self.session_entry.delete(0, END)
         self.session_entry.insert(0, self.sessionID)
+        threading.Thread(target=self.sync_session_clock, daemon=True).start()
+
+    def sync_session_clock(self):
+        # pi clock offset at session start, kept next to the blocks
+        rpi = RigStateMachineConnection(timeout_s=5.)
+        rpi.connect()
+        try:
+            clock_sync = ClockSync(rpi)
+            clock_sync.sync()
+            pi = clock_sync.write(self.session_path)['pi']
+            print('Pi clock offset {:+.6f} s (+/- {:.6f})'.format(pi['offset'], pi['offset_ci']))
+        except (zmq.ZMQError, RuntimeError) as e:
+            print('Could not sync with the pi: {}'.format(e))
+        finally:
+            rpi.close()
 
     def copy_stimuli(self):
         # Copies stimuli over to raspi via ssh
-        ssh = SSHClient()
-        ssh.load_system_host_keys()
-        ssh.connect('192.168.1.5', username='pi')
-        with SCPClient(ssh.get_transport()) as scp:
-            for stimulus in self.stimuli:
+        paramiko = lazy_import('ssh', 'paramiko')
+        scp_module = lazy_import('ssh', 'scp')
+        with timed('ssh'):
+            ssh = paramiko.SSHClient()
+            ssh.load_system_host_keys()
+            ssh.connect('192.168.1.5', username='pi')
+        with scp_module.SCPClient(ssh.get_transport()) as scp:
+            for i, stimulus in enumerate(self.stimuli):
+                self.set_prep_status('Uploading stimuli {} of {}'.format(i + 1, len(self.stimuli)))
                 scp.put(stimulus, remote_path='/home/pi/stimuli')
 
     def run(self):
         self.master_window.mainloop()
 
 if __name__ == '__main__':
-    root = Tk()
+    with timed('tk'):
+        root = Tk()
     app = AcuteExperimentControl(root)
+    # report once the window is up and the event loop is idle
+    root.after_idle(print_startup_report)
     app.run()
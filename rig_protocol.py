@@ -0,0 +1,186 @@
+"""
+Wire protocol between the rig control GUI and the Raspberry Pi state machine.
+Used by RigStateMachineConnection (python 3) and rig_state_machine (python 2),
+so keep it to the standard library and code that runs on both.
+
+A message is a batch of commands, each a name and a dictionary of typed parameters:
+
+    header   : magic 'GR', version (u8), number of commands (u16)
+    command  : name (string), number of params (u16), then per param
+               key (string), type code (1 byte), value
+    string   : length (u32) followed by utf-8 bytes
+
+Type codes: 'i' int64, 'd' float64, 's' string, '?' bool, 'n' None.
+Replies use the same format, one reply per command in the batch.
+
+Run this module to benchmark encode/decode and a zmq round trip.
+"""
+import struct
+import sys
+
+MAGIC = b'GR'
+PROTOCOL_VERSION = 1
+
+HEADER = struct.Struct('<2sBH')
+COUNT = struct.Struct('<H')
+LENGTH = struct.Struct('<I')
+INT = struct.Struct('<q')
+FLOAT = struct.Struct('<d')
+BOOL = struct.Struct('<?')
+
+if sys.version_info[0] >= 3:
+    text_type = str
+    integer_types = (int,)
+
+    def to_native(raw):
+        return raw.decode('utf-8')
+else:
+    text_type = unicode
+    integer_types = (int, long)
+
+    def to_native(raw):
+        # python 2 str is bytes already
+        return raw
+
+
+class ProtocolError(ValueError):
+    pass
+
+
+def pack_string(value):
+    if isinstance(value, text_type):
+        value = value.encode('utf-8')
+    return LENGTH.pack(len(value)) + value
+
+
+def pack_value(value):
+    if value is None:
+        return b'n'
+    if isinstance(value, bool):
+        return b'?' + BOOL.pack(value)
+    if isinstance(value, integer_types):
+        return b'i' + INT.pack(value)
+    if isinstance(value, float):
+        return b'd' + FLOAT.pack(value)
+    if isinstance(value, (text_type, bytes)):
+        return b's' + pack_string(value)
+    raise ProtocolError('Can not send value of type %s' % type(value).__name__)
+
+
+def encode(commands):
+    """
+    :param commands: list of (name, params) with params a dictionary {str: int/float/str/bool/None}
+    :return: bytes of one message holding all the commands
+    """
+    parts = [HEADER.pack(MAGIC, PROTOCOL_VERSION, len(commands))]
+    for name, params in commands:
+        params = params or {}
+        parts.append(pack_string(name))
+        parts.append(COUNT.pack(len(params)))
+        for key, value in params.items():
+            parts.append(pack_string(key))
+            parts.append(pack_value(value))
+    return b''.join(parts)
+
+
+def encode_command(name, params=None):
+    return encode([(name, params)])
+
+
+class Reader:
+
+    def __init__(self, data):
+        self.data = data
+        self.pos = 0
+
+    def take(self, n):
+        if self.pos + n > len(self.data):
+            raise ProtocolError('Message truncated')
+        chunk = self.data[self.pos:self.pos + n]
+        self.pos += n
+        return chunk
+
+    def unpack(self, fmt):
+        return fmt.unpack(self.take(fmt.size))[0]
+
+    def string(self):
+        return to_native(self.take(self.unpack(LENGTH)))
+
+    def value(self):
+        code = self.take(1)
+        if code == b'n':
+            return None
+        if code == b'?':
+            return self.unpack(BOOL)
+        if code == b'i':
+            return self.unpack(INT)
+        if code == b'd':
+            return self.unpack(FLOAT)
+        if code == b's':
+            return self.string()
+        raise ProtocolError('Unknown type code %r' % code)
+
+
+def decode(data):
+    """
+    :param data: bytes of a message made by encode
+    :return: list of (name, params)
+    """
+    reader = Reader(data)
+    magic, version, n_commands = HEADER.unpack(reader.take(HEADER.size))
+    if magic != MAGIC:
+        raise ProtocolError('Not a rig protocol message')
+    if version != PROTOCOL_VERSION:
+        raise ProtocolError('Protocol version %d, expected %d' % (version, PROTOCOL_VERSION))
+    commands = []
+    for _ in range(n_commands):
+        name = reader.string()
+        params = {}
+        for _ in range(reader.unpack(COUNT)):
+            key = reader.string()
+            params[key] = reader.value()
+        commands.append((name, params))
+    if reader.pos != len(data):
+        raise ProtocolError('Trailing bytes after message')
+    return commands
+
+
+def benchmark(n=20000, batch=8):
+    import timeit
+    import threading
+    import zmq
+
+    trial = ('trial', {'stim_file': '/home/pi/stimuli/a stimulus with spaces.wav.sine', 'number': 123})
+    single = encode([trial])
+    batched = encode([trial] * batch)
+    print('Message size: %d bytes, %d bytes for a batch of %d' % (len(single), len(batched), batch))
+    for label, stmt in [('encode', lambda: encode([trial])),
+                        ('decode', lambda: decode(single)),
+                        ('encode batch of %d' % batch, lambda: encode([trial] * batch)),
+                        ('decode batch of %d' % batch, lambda: decode(batched))]:
+        t = timeit.timeit(stmt, number=n)
+        print('%-20s %8.2f us' % (label, 1e6 * t / n))
+
+    context = zmq.Context()
+    server = context.socket(zmq.REP)
+    server.bind('inproc://bench')
+
+    def echo():
+        for _ in range(n):
+            commands = decode(server.recv())
+            server.send(encode([('ok', {}) for _ in commands]))
+
+    thread = threading.Thread(target=echo)
+    thread.start()
+    client = context.socket(zmq.REQ)
+    client.connect('inproc://bench')
+    t = timeit.timeit(lambda: (client.send(encode([trial])), decode(client.recv())), number=n)
+    thread.join()
+    print('%-20s %8.2f us' % ('zmq round trip', 1e6 * t / n))
+    client.close()
+    server.close()
+    context.term()
+
+
+if __name__ == '__main__':
+    benchmark()
@@ -6,53 +6,150 @@ import os
 import zmq
 import serial
 import struct
+import threading
+import io
 import RPi.GPIO as GPIO
+import rig_protocol
+try:
+    import queue
+except ImportError:
+    import Queue as queue
 
 
 # Classes and functions
 
+try:
+    buffer
+    def read_only_view(data, start, size):
+        return buffer(data, start, size)
+except NameError:
+    def read_only_view(data, start, size):
+        return memoryview(data).toreadonly()[start:start + size]
+
+
+def find_data_chunk(f):
+    # offset and size of the sample data in an open RIFF/WAVE file
+    riff, _, wave_id = struct.unpack('<4sI4s', f.read(12))
+    if riff != b'RIFF' or wave_id != b'WAVE':
+        raise ValueError('Not a wave file')
+    while True:
+        header = f.read(8)
+        if len(header) < 8:
+            raise ValueError('No data chunk')
+        chunk_id, size = struct.unpack('<4sI', header)
+        if chunk_id == b'data':
+            return f.tell(), size
+        # chunks are padded to an even size
+        f.seek(size + (size & 1), 1)
+
+
 class WavPlayer():
-    def __init__(self, pin = 5):
+    # The sample data of each file is read into one buffer before the stream starts
+    # and cut into read-only views, one per callback, so the PortAudio thread only
+    # hands out prebuilt (view, flag) tuples: no reads and no copies while playing.
+    def __init__(self, pin = 5, frames_per_buffer=1024):
         
         self.pin = pin
+        self.frames_per_buffer = frames_per_buffer
         self.pa = pyaudio.PyAudio()
-        self.wf = None
+        self.sample_width = None
+        self.n_channels = None
+        self.frame_rate = None
         self.played = False
+        self.abort_flag = threading.Event()
+        self.t_onset = None
+        # grows to the largest stimulus and is reused after that
+        self.buffer = bytearray(0)
+        self.chunks = []
+        self.chunk_index = 0
+        self.done_chunk = (b'', pyaudio.paComplete)
+        self.abort_chunk = (b'', pyaudio.paAbort)
+        self.reset_stats()
     
         # init the pins
         GPIO.setup(self.pin, GPIO.OUT)
         GPIO.output(self.pin, GPIO.LOW)
     
     
+    def reset_stats(self):
+        self.n_callbacks = 0
+        self.n_underruns = 0
+        self.callback_total_s = 0.
+        self.callback_max_s = 0.
+
+    def stats(self):
+        return {'callbacks': self.n_callbacks,
+                'underruns': self.n_underruns,
+                'callback_mean_ms': 1000. * self.callback_total_s / max(self.n_callbacks, 1),
+                'callback_max_ms': 1000. * self.callback_max_s}
+
     def play_callback(self, in_data, frame_count, time_info, status):
-        data = self.wf.readframes(frame_count)
-        return (data, pyaudio.paContinue)
-        
+        t0 = time.time()
+        if status & pyaudio.paOutputUnderflow:
+            self.n_underruns += 1
+        if self.abort_flag.is_set():
+            chunk = self.abort_chunk
+        elif self.chunk_index < len(self.chunks):
+            chunk = self.chunks[self.chunk_index]
+            self.chunk_index += 1
+        else:
+            chunk = self.done_chunk
+        dt = time.time() - t0
+        self.n_callbacks += 1
+        self.callback_total_s += dt
+        if dt > self.callback_max_s:
+            self.callback_max_s = dt
+        return chunk
+
+    def load_file(self, wave_file_path):
+        wf = wave.open(wave_file_path, 'rb')
+        self.sample_width = wf.getsampwidth()
+        self.n_channels = wf.getnchannels()
+        self.frame_rate = wf.getframerate()
+        wf.close()
+        with io.open(wave_file_path, 'rb') as f:
+            offset, size = find_data_chunk(f)
+            if len(self.buffer) < size:
+                self.buffer = bytearray(size)
+            f.seek(offset)
+            size = f.readinto(memoryview(self.buffer)[:size])
+        frame_bytes = self.sample_width * self.n_channels
+        step = self.frames_per_buffer * frame_bytes
+        starts = range(0, size, step)
+        self.chunks = [(read_only_view(self.buffer, start, min(step, size - start)), pyaudio.paContinue)
+                       for start in starts]
+        if self.chunks:
+            self.chunks[-1] = (self.chunks[-1][0], pyaudio.paComplete)
+        self.chunk_index = 0
     
     def play_file(self, wave_file_path):
-        self.wf = wave.open(wave_file_path, 'rb')
-        stream = self.pa.open(format=self.pa.get_format_from_width(self.wf.getsampwidth()),
-                channels=self.wf.getnchannels(),
-                rate=self.wf.getframerate(),
+        self.load_file(wave_file_path)
+        self.reset_stats()
+        stream = self.pa.open(format=self.pa.get_format_from_width(self.sample_width),
+                channels=self.n_channels,
+                rate=self.frame_rate,
                 output=True,
+                frames_per_buffer=self.frames_per_buffer,
                 stream_callback=self.play_callback)
         
         GPIO.output(self.pin, GPIO.HIGH)
+        self.t_onset = time.time()
         stream.start_stream()
         
-        while stream.is_active():
-            #time.sleep(0.1)
-            pass
+        # sleep rather than spin so the command server thread keeps the GIL available
+        while stream.is_active() and not self.abort_flag.is_set():
+            time.sleep(0.005)
         GPIO.output(self.pin, GPIO.LOW)
         time.sleep(0.1)
         stream.stop_stream()
         stream.close()
         self.flush_file()
+        return 'aborted' if self.abort_flag.is_set() else 'played'
     
     
     def flush_file(self):
-        self.wf = None
         self.played = False
+        self.chunks = []
         
 class SerialOutput():
     def __init__(self, port="/dev/ttyS0", baudrate=300):
@@ -71,17 +168,96 @@ class SerialOutput():
     
     def write_number(self, number, dtype='L'):
         self.serial.write(struct.pack(dtype, number))
-    
 
-# receives a line and turns it into a dictionary
-# the line has one word for the command and n pairs that go to key, value (separator is space)
-def parse_command(cmd_str):
-    split_cmd = cmd_str.split(' ')
-    assert(len(split_cmd)%2)
-    cmd_par = {split_cmd[i] : split_cmd[i+1] for i in range(1, len(split_cmd), 2)}
-    cmd = split_cmd[0]
-    return cmd, cmd_par
 
+class PendingReply():
+    # the replies to one message, sent back once every trial in it has played
+    def __init__(self, envelope, n_commands):
+        self.envelope = envelope
+        self.replies = [None] * n_commands
+        self.n_pending = 0
+
+    def frames(self):
+        return self.envelope + [rig_protocol.encode(self.replies)]
+
+
+class TrialWorker(threading.Thread):
+    # plays queued trials in order, off the command socket thread, so that
+    # status/abort/ping can be answered while a stimulus is playing.
+    # finished trials are handed back to the server over an inproc PAIR socket
+    # because zmq sockets can't be shared between threads
+    done_url = 'inproc://trial_done'
+
+    def __init__(self, context, port):
+        threading.Thread.__init__(self)
+        self.daemon = True
+        self.context = context
+        self.port = port
+        self.trials = queue.Queue()
+        self.lock = threading.Lock()
+        self.current = None
+        self.n_submitted = 0
+        self.aborted_upto = 0
+        self.n_played = 0
+        self.n_aborted = 0
+
+    def submit(self, reply, slot, trial_pars):
+        with self.lock:
+            self.n_submitted += 1
+            self.trials.put((self.n_submitted, reply, slot, trial_pars))
+
+    def run(self):
+        done = self.context.socket(zmq.PAIR)
+        done.connect(self.done_url)
+        while True:
+            seq, reply, slot, trial_pars = self.trials.get()
+            with self.lock:
+                skip = seq <= self.aborted_upto
+                if not skip:
+                    wp.abort_flag.clear()
+                    self.current = trial_pars
+            if skip:
+                response = ('aborted', {})
+                with self.lock:
+                    self.n_aborted += 1
+            else:
+                try:
+                    response = run_trial(trial_pars)
+                except Exception as e:
+                    response = ('error', {'message': str(e)})
+                time.sleep(1)
+                with self.lock:
+                    self.current = None
+                    if response[0] == 'played':
+                        self.n_played += 1
+                    elif response[0] == 'aborted':
+                        self.n_aborted += 1
+            # only this thread touches a reply once its trials are submitted
+            reply.replies[slot] = response
+            reply.n_pending -= 1
+            if reply.n_pending == 0:
+                done.send_multipart(reply.frames())
+
+    def status(self, pars):
+        with self.lock:
+            return ('status', {'state': 'playing' if self.current else 'idle',
+                               'trial': self.current['number'] if self.current else -1,
+                               'stim_file': self.current['stim_file'] if self.current else None,
+                               'queue': self.trials.qsize(),
+                               'played': self.n_played,
+                               'aborted': self.n_aborted})
+
+    def abort(self, pars):
+        # everything submitted so far is dropped, including the trial that is playing
+        with self.lock:
+            n_aborted = self.trials.qsize() + (1 if self.current else 0)
+            self.aborted_upto = self.n_submitted
+            wp.abort_flag.set()
+        return ('aborted', {'n': n_aborted})
+
+
+# commands come in batches of (name, params) from rig_protocol,
+# each command function returns a (name, params) reply
 def execute_command(cmd, pars):
     command = command_functions[cmd]
     response = command(pars)
@@ -91,45 +267,92 @@ def run_trial(trial_pars):
     #for now the trial is just playing a sound file
     # read the parameters
     wavefile_path = trial_pars['stim_file']
-    trial_number = int(float(trial_pars['number']))
+    trial_number = trial_pars['number']
     
     # do the deed
     so.write_number(trial_number)
     time.sleep(0.5)
-    wp.play_file(wavefile_path)
-    return 'played'
+    result = wp.play_file(wavefile_path)
+    # pi clock, the host converts it with its clock sync fit
+    reply = {'t_onset': wp.t_onset}
+    reply.update(wp.stats())
+    return (result, reply)
 
-def init_board():
+def init_board(pars=None):
     # init the board, the pins, and everything
     GPIO.setmode(GPIO.BCM)
-    return 'ok'
+    return ('ok', {})
 
-def state_machine():
-    command_functions = {'trial' : run_trial, 'init' : init_board}
+def ping(pars):
+    return ('pong', {})
+
+def sync(pars):
+    # one NTP style exchange, the host brackets it with its own send/receive times
+    t_recv = time.time()
+    return ('sync', {'t_recv': t_recv, 't_send': time.time()})
 
+def state_machine():
     # Configuration of Pins
     pin_audio = 26 
     port = "5558"
     wave_file = os.path.abspath('/root/experiment/stim/audiocheck.net_sin_1000Hz_-3dBFS_3s.wav')
 
-    # a very simple server that waits for commands
+    # a ROUTER server: any number of REQ/DEALER clients can connect.
+    # trials are queued to the worker and a message is answered when its
+    # trials have played, every other command is run right away
     context = zmq.Context()
-    socket = context.socket(zmq.REP)
+    socket = context.socket(zmq.ROUTER)
     socket.bind("tcp://*:%s" % port)
+    done = context.socket(zmq.PAIR)
+    done.bind(TrialWorker.done_url)
     print('Setup ZMQ')
 
+    worker = TrialWorker(context, port)
+    command_functions['status'] = worker.status
+    command_functions['abort'] = worker.abort
+    worker.start()
+
+    poller = zmq.Poller()
+    poller.register(socket, zmq.POLLIN)
+    poller.register(done, zmq.POLLIN)
+
+    print('Waiting for commands...')
     while True:
-        print('Waiting for commands...')
-        # Wait for next request from client
-        command = socket.recv()
-        print("Received request: " + command)
-        
-        cmd, cmd_par = parse_command(command)
-        response = execute_command(cmd, cmd_par)
-        time.sleep(1) 
-        socket.send("%s from %s" % (response, port))
+        events = dict(poller.poll())
+        if done in events:
+            socket.send_multipart(done.recv_multipart())
+
+        if socket in events:
+            # [identity, (empty delimiter,) message]
+            frames = socket.recv_multipart()
+            envelope = frames[:-1]
+            try:
+                commands = rig_protocol.decode(frames[-1])
+            except rig_protocol.ProtocolError as e:
+                socket.send_multipart(envelope + [rig_protocol.encode_command('error', {'message': str(e)})])
+                continue
+            print("Received request: %s" % commands)
+
+            reply = PendingReply(envelope, len(commands))
+            trials = []
+            for slot, (cmd, cmd_par) in enumerate(commands):
+                if cmd == 'trial':
+                    trials.append((slot, cmd_par))
+                    continue
+                try:
+                    reply.replies[slot] = execute_command(cmd, cmd_par)
+                except Exception as e:
+                    reply.replies[slot] = ('error', {'message': '%s: %s' % (cmd, e)})
+
+            if trials:
+                reply.n_pending = len(trials)
+                for slot, cmd_par in trials:
+                    worker.submit(reply, slot, cmd_par)
+            else:
+                socket.send_multipart(reply.frames())
 
-command_functions = {'trial' : run_trial, 'init' : init_board}
+# trial is not in here, trials go through the TrialWorker queue
+command_functions = {'init' : init_board, 'ping' : ping, 'sync' : sync}
 
 if __name__ == '__main__':
     print('Gentnerlab OpenEphys Rig State Machine')